@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Fork server of Odoo: a python process with the Odoo code already imported,
+forked to run each server command, to save its startup time.
+
+Usage:
+
+    fork_server.py serve <socket> <server_path>
+    fork_server.py run <socket> [--coverage] [--parallel-mode] -- <argv>...
+
+`serve` imports Odoo and waits for commands in the unix socket. `run` sends
+the command to the server with its standard input and outputs (so the
+output can be read or unbuffered like the one of the server itself), and
+exits with the exit code of the command.
+"""
+
+from __future__ import print_function
+
+import array
+import json
+import os
+import runpy
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+
+def is_supported():
+    """Sending file descriptors between processes needs python 3"""
+    return hasattr(socket.socket, 'sendmsg')
+
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data += chunk
+    return data
+
+
+def run_command(conn):
+    """Run the command received in a forked process, with the standard
+    input and outputs of the client, and send back its exit code"""
+    fds = array.array('i')
+    header, ancdata, _, _ = conn.recvmsg(
+        4, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - (len(data) % fds.itemsize)])
+    request = json.loads(recv_exactly(
+        conn, struct.unpack('!I', header)[0]).decode('UTF-8'))
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.argv = request['argv']
+    cov = None
+    if request['coverage']:
+        import coverage
+        cov = coverage.Coverage(data_suffix=request['parallel'] or None)
+        cov.start()
+    code = 0
+    try:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        if cov is not None:
+            cov.stop()
+            cov.save()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    conn.sendall(str(code).encode('UTF-8'))
+    os._exit(code)
+
+
+def serve(sock_path, server_path):
+    """Import Odoo and fork a process for each command received"""
+    sys.path.insert(0, server_path)
+    for name in ('odoo', 'openerp'):
+        try:
+            __import__(name + '.cli')
+            break
+        except ImportError:
+            continue
+    else:
+        print("Odoo not found in %s, nothing preloaded" % server_path)
+    # The commands are not waited for, their exit code is sent by themselves
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(sock_path + '.tmp')
+    sock.listen(16)
+    os.rename(sock_path + '.tmp', sock_path)
+    while True:
+        conn, _ = sock.accept()
+        if os.fork() == 0:
+            sock.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                run_command(conn)
+            finally:
+                os._exit(1)
+        conn.close()
+
+
+def run(sock_path, argv, coverage=False, parallel=False):
+    """Run a command in the fork server
+    :return: Exit code of the command
+    """
+    request = json.dumps({
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'coverage': coverage,
+        'parallel': parallel,
+    }).encode('UTF-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sock_path)
+    sock.sendmsg(
+        [struct.pack('!I', len(request))],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [0, 1, 2]))])
+    sock.sendall(request)
+    code = b''
+    while True:
+        chunk = sock.recv(16)
+        if not chunk:
+            break
+        code += chunk
+    return int(code or 1)
+
+
+class ForkServer(object):
+    """Fork server started in a subprocess, used by the test commands"""
+
+    def __init__(self, server_path):
+        """
+        :param server_path: Path of the Odoo server code to preload
+        """
+        self.tmp_dir = tempfile.mkdtemp(prefix='mqt_fork_server_')
+        self.sock_path = os.path.join(self.tmp_dir, 'socket')
+        self.process = subprocess.Popen([
+            sys.executable, os.path.realpath(__file__),
+            'serve', self.sock_path, server_path])
+
+    def wait_ready(self, timeout=60):
+        """Wait for Odoo to be imported
+        :return: True if the server is ready
+        """
+        end = time.time() + timeout
+        while time.time() < end and self.process.poll() is None:
+            if os.path.exists(self.sock_path):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def command(self, coverage=False, parallel=False):
+        """Get the command prefix running a command in this server
+        :param coverage: Measure the coverage of the command
+        :param parallel: Write the coverage data in its own file
+        :return: List with the command prefix
+        """
+        cmd = [sys.executable, os.path.realpath(__file__),
+               'run', self.sock_path]
+        if coverage:
+            cmd.append('--coverage')
+        if parallel:
+            cmd.append('--parallel-mode')
+        return cmd + ['--']
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        for fname in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, fname))
+        os.rmdir(self.tmp_dir)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    if len(argv) >= 4 and argv[1] == 'serve':
+        serve(argv[2], argv[3])
+        return 0
+    if len(argv) >= 4 and argv[1] == 'run' and '--' in argv:
+        options = argv[3:argv.index('--')]
+        return run(argv[2], argv[argv.index('--') + 1:],
+                   coverage='--coverage' in options,
+                   parallel='--parallel-mode' in options)
+    print(__doc__)
+    return 1
+
+
+if __name__ == '__main__':
+    exit(main())
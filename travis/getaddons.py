@@ -6,11 +6,21 @@ With -m flag, will return a list of modules names instead.
 """
 
 import ast
+import atexit
+import json
 import os
 import sys
 
 from git_run import GitRun
 
+try:
+    from os import scandir
+except ImportError:  # python2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 MANIFEST_FILES = [
     '__manifest__.py',
     '__odoo__.py',
@@ -18,6 +28,93 @@ MANIFEST_FILES = [
     '__terp__.py',
 ]
 
+# Manifests already parsed, by path: [[mtime, size], manifest]
+MANIFEST_CACHE = {}
+_manifest_cache_state = {'loaded': False, 'changed': False}
+
+
+def load_manifest_cache(fname=None):
+    """Load the manifests parsed by previous processes from the file fname,
+    or from the file set in the environment variable MQT_MANIFEST_CACHE.
+    The manifests parsed are then saved in that file at exit."""
+    if _manifest_cache_state['loaded']:
+        return
+    _manifest_cache_state['loaded'] = True
+    fname = fname or os.environ.get('MQT_MANIFEST_CACHE')
+    if not fname:
+        return
+    fname = os.path.expanduser(fname)
+    try:
+        with open(fname) as cache_file:
+            manifests = json.load(cache_file)
+    except (IOError, ValueError):
+        # No cache yet, or a corrupted one that will be overwritten
+        manifests = {}
+    for manifest_path, cached in manifests.items():
+        if os.path.isfile(manifest_path):
+            MANIFEST_CACHE[manifest_path] = cached
+        else:
+            # The module was removed, not kept in the cache
+            _manifest_cache_state['changed'] = True
+    atexit.register(save_manifest_cache, fname)
+
+
+def save_manifest_cache(fname):
+    """Save the manifests parsed in the file fname"""
+    if not _manifest_cache_state['changed']:
+        return
+    manifests = {}
+    for manifest_path, cached in MANIFEST_CACHE.items():
+        try:
+            json.dumps(cached)
+        except TypeError:
+            # A manifest with values not supported by json (e.g. a set),
+            # parsed again by the next processes
+            continue
+        manifests[manifest_path] = cached
+    # Write a temporary file to not leave a partial cache
+    # if another process is using it
+    tmp_fname = '%s.%d' % (fname, os.getpid())
+    cache_dir = os.path.dirname(os.path.abspath(fname))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_fname, 'w') as cache_file:
+            json.dump(manifests, cache_file)
+        os.rename(tmp_fname, fname)
+    except (IOError, OSError):
+        # e.g. a read-only folder, the manifests are parsed again
+        return
+    _manifest_cache_state['changed'] = False
+
+
+def read_manifest(manifest_path):
+    """Return the content of the manifest in manifest_path.
+    Each manifest is parsed only once until it is changed (according to its
+    modification time and size). The result is shared, don't modify it."""
+    load_manifest_cache()
+    manifest_path = os.path.abspath(manifest_path)
+    stat = os.stat(manifest_path)
+    key = [stat.st_mtime, stat.st_size]
+    cached = MANIFEST_CACHE.get(manifest_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(manifest_path) as manifest_file:
+        manifest = ast.literal_eval(manifest_file.read())
+    MANIFEST_CACHE[manifest_path] = [key, manifest]
+    _manifest_cache_state['changed'] = True
+    return manifest
+
+
+def get_manifest_path(path, names):
+    """Return the full path to the module manifest if the names of the
+    entries of path are the ones of an odoo module, False otherwise"""
+    filtered = [x for x in names if x in (MANIFEST_FILES + ['__init__.py'])]
+    if len(filtered) == 2 and '__init__.py' in filtered:
+        return os.path.join(
+            path, next(x for x in filtered if x != '__init__.py'))
+    return False
+
 
 def is_module(path):
     """return False if the path doesn't contain an odoo module, and the full
@@ -25,13 +122,16 @@ def is_module(path):
 
     if not os.path.isdir(path):
         return False
-    files = os.listdir(path)
-    filtered = [x for x in files if x in (MANIFEST_FILES + ['__init__.py'])]
-    if len(filtered) == 2 and '__init__.py' in filtered:
-        return os.path.join(
-            path, next(x for x in filtered if x != '__init__.py'))
-    else:
-        return False
+    return get_manifest_path(path, os.listdir(path))
+
+
+def list_dir(path):
+    """Return a list of tuples (name, is_dir) of the entries of path,
+    using the type given by scandir when available to avoid stat calls."""
+    if scandir is None:
+        return [(name, os.path.isdir(os.path.join(path, name)))
+                for name in os.listdir(path)]
+    return [(entry.name, entry.is_dir()) for entry in scandir(path)]
 
 
 def get_modules(path, depth=1):
@@ -40,56 +140,91 @@ def get_modules(path, depth=1):
 
 
 def get_modules_info(path, depth=1):
-    """ Return a digest of each installable module's manifest in path repo"""
+    """ Return a digest of each installable module's manifest in path repo.
+    Each directory is listed once."""
     # Avoid empty basename when path ends with slash
     if not os.path.basename(path):
         path = os.path.dirname(path)
 
     modules = {}
-    if os.path.isdir(path) and depth > 0:
-        for module in os.listdir(path):
-            manifest_path = is_module(os.path.join(path, module))
-            if manifest_path:
-                manifest = ast.literal_eval(open(manifest_path).read())
-                if manifest.get('installable', True):
-                    modules[module] = {
-                        'application': manifest.get('application'),
-                        'depends': manifest.get('depends') or [],
-                        'auto_install': manifest.get('auto_install'),
-                    }
-            else:
-                deeper_modules = get_modules_info(
-                    os.path.join(path, module), depth-1)
-                modules.update(deeper_modules)
+    if depth <= 0:
+        return modules
+    try:
+        entries = list_dir(path)
+    except OSError:
+        # Not a directory
+        return modules
+    for module, is_dir in entries:
+        if not is_dir:
+            continue
+        module_path = os.path.join(path, module)
+        manifest_path = get_manifest_path(
+            module_path, [name for name, _ in list_dir(module_path)])
+        if manifest_path:
+            manifest = read_manifest(manifest_path)
+            if manifest.get('installable', True):
+                modules[module] = {
+                    'application': manifest.get('application'),
+                    'depends': manifest.get('depends') or [],
+                    'auto_install': manifest.get('auto_install'),
+                }
+        elif depth > 1:
+            modules.update(get_modules_info(module_path, depth - 1))
     return modules
 
 
-def is_addons(path):
-    res = get_modules(path) != []
-    return res
-
-
 def get_addons(path, depth=1):
-    """Return repositories in path. Can search in inner folders as depth."""
-    if not os.path.exists(path) or depth < 0:
-        return []
-    res = []
-    if is_addons(path):
-        res.append(path)
-    else:
-        new_paths = [os.path.join(path, x)
-                     for x in sorted(os.listdir(path))
-                     if os.path.isdir(os.path.join(path, x))]
-        for new_path in new_paths:
-            res.extend(get_addons(new_path, depth-1))
-    return res
+    """Return repositories in path. Can search in inner folders as depth.
+    Each directory is listed once, the listing of the folders of a path is
+    used both to know if they are modules and to search in them."""
+    addons_paths = []
+    listings = {}
+
+    def get_listing(path):
+        if path not in listings:
+            try:
+                listings[path] = list_dir(path)
+            except OSError:
+                # Not a directory
+                listings[path] = []
+        return listings[path]
+
+    def scan(path, depth):
+        if depth < 0 or not os.path.exists(path):
+            return
+        subpaths = [os.path.join(path, name)
+                    for name, is_dir in sorted(get_listing(path))
+                    if is_dir]
+        for subpath in subpaths:
+            manifest_path = get_manifest_path(
+                subpath, [name for name, _ in get_listing(subpath)])
+            if (manifest_path and
+                    read_manifest(manifest_path).get('installable', True)):
+                addons_paths.append(path)
+                return
+        for subpath in subpaths:
+            scan(subpath, depth - 1)
+
+    scan(path, depth)
+    return addons_paths
+
+
+def get_branch_base():
+    """Get the branch to compare with to find the changes of a pull request
+    :return: String with the name of the remote branch or HEAD
+    """
+    branch_base = os.environ.get('TRAVIS_BRANCH') or os.environ.get('VERSION')
+    if branch_base != 'HEAD':
+        branch_base = 'origin/' + (branch_base and branch_base or '')
+    return branch_base
 
 
-def get_modules_changed(path, ref='HEAD'):
-    """Get modules changed from git diff-index {ref}
+def get_items_changed(path, ref='HEAD'):
+    """Get items changed from git diff-index {ref}
     :param path: String path of git repo
     :param ref: branch or remote/branch or sha to compare
-    :return: List of paths of modules changed
+    :return: List of paths (relative to the repo) of the items changed,
+        or None if they can't be known
     """
     git_run_obj = GitRun(os.path.join(path, '.git'))
     if ref != 'HEAD':
@@ -98,7 +233,16 @@ def get_modules_changed(path, ref='HEAD'):
             # to force create branch
             fetch_ref += ':' + fetch_ref
         git_run_obj.run(['fetch'] + fetch_ref.split('/', 1))
-    items_changed = git_run_obj.get_items_changed(ref)
+    return git_run_obj.get_items_changed(ref)
+
+
+def get_modules_changed(path, ref='HEAD'):
+    """Get modules changed from git diff-index {ref}
+    :param path: String path of git repo
+    :param ref: branch or remote/branch or sha to compare
+    :return: List of paths of modules changed
+    """
+    items_changed = get_items_changed(path, ref) or []
     folders_changed = set([
         item_changed.split('/')[0]
         for item_changed in items_changed
@@ -112,58 +256,122 @@ def get_modules_changed(path, ref='HEAD'):
     return modules_changed_path
 
 
+class ModuleGraph(object):
+    """Dependency graph of the modules returned by get_modules_info.
+    The transitive dependencies and dependents of each module are computed
+    once, without recursion, reusing the ones already computed."""
+
+    def __init__(self, modules):
+        self.modules = modules
+        self._dependents_index = None
+        self._dependencies_cache = {}
+        self._dependents_cache = {}
+
+    def get_depends(self, module_name):
+        """Return the direct dependencies of the module_name"""
+        return self.modules.get(module_name, {}).get('depends', [])
+
+    def get_direct_dependents(self, module_name):
+        """Return the modules that depend directly on the module_name"""
+        if self._dependents_index is None:
+            self._dependents_index = {}
+            for module in self.modules:
+                for dependency in self.get_depends(module):
+                    self._dependents_index.setdefault(
+                        dependency, []).append(module)
+        return self._dependents_index.get(module_name, [])
+
+    @staticmethod
+    def _closure(module_name, neighbours, cache):
+        if module_name in cache:
+            return cache[module_name]
+        result = set([module_name])
+        stack = [module_name]
+        while stack:
+            module = stack.pop()
+            if module != module_name and module in cache:
+                result |= cache[module]
+                continue
+            for neighbour in neighbours(module):
+                if neighbour not in result:
+                    result.add(neighbour)
+                    stack.append(neighbour)
+        cache[module_name] = result = frozenset(result)
+        return result
+
+    def get_dependencies(self, module_name):
+        """Return a frozenset of all the dependencies in deep of the
+        module_name. The module_name is included in the result."""
+        return self._closure(
+            module_name, self.get_depends, self._dependencies_cache)
+
+    def get_dependents(self, module_name):
+        """Return a frozenset of all the modules that are dependent of the
+        module_name. The module_name is included in the result."""
+        return self._closure(
+            module_name, self.get_direct_dependents, self._dependents_cache)
+
+
 def get_dependencies(modules, module_name):
     """Return a set of all the dependencies in deep of the module_name.
-    The module_name is included in the result."""
-    result = set()
-    for dependency in modules.get(module_name, {}).get('depends', []):
-        result |= get_dependencies(modules, dependency)
-    return result | set([module_name])
+    The module_name is included in the result.
+    Use a ModuleGraph to get the dependencies of several modules."""
+    return set(ModuleGraph(modules).get_dependencies(module_name))
 
 
 def get_dependents(modules, module_name):
     """Return a set of all the modules that are dependent of the module_name.
-    The module_name is included in the result."""
-    result = set()
-    for dependent in modules.keys():
-        if module_name in modules.get(dependent, {}).get('depends', []):
-            result |= get_dependents(modules, dependent)
-    return result | set([module_name])
+    The module_name is included in the result.
+    Use a ModuleGraph to get the dependents of several modules."""
+    return set(ModuleGraph(modules).get_dependents(module_name))
 
 
 def add_auto_install(modules, to_install):
     """ Append automatically installed glue modules to to_install if their
     dependencies are already present. to_install is a set. """
-    found = True
-    while found:
-        found = False
-        for module, module_data in modules.items():
-            if (module_data.get('auto_install') and
-                    module not in to_install and
-                    all(dependency in to_install
-                        for dependency in module_data.get('depends', []))):
-                found = True
-                to_install.add(module)
+    # Number of dependencies not installed yet of each glue module,
+    # and the glue modules waiting for each of these dependencies
+    pending = {}
+    waiting = {}
+    ready = []
+    for module, module_data in modules.items():
+        if not module_data.get('auto_install') or module in to_install:
+            continue
+        missing = set(module_data.get('depends', [])) - to_install
+        pending[module] = len(missing)
+        for dependency in missing:
+            waiting.setdefault(dependency, []).append(module)
+        if not missing:
+            ready.append(module)
+    while ready:
+        module = ready.pop()
+        to_install.add(module)
+        for waiting_module in waiting.get(module, []):
+            pending[waiting_module] -= 1
+            if not pending[waiting_module]:
+                ready.append(waiting_module)
     return to_install
 
 
 def get_applications_with_dependencies(modules):
     """ Return all modules marked as application with their dependencies.
     For our purposes, l10n modules cannot be an application. """
+    graph = ModuleGraph(modules)
     result = set()
     for module, module_data in modules.items():
         if module_data.get('application') and not module.startswith('l10n_'):
-            result |= get_dependencies(modules, module)
+            result |= graph.get_dependencies(module)
     return add_auto_install(modules, result)
 
 
 def get_localizations_with_dependents(modules):
     """ Return all localization modules with the modules that depend on them
     """
+    graph = ModuleGraph(modules)
     result = set()
     for module in modules.keys():
         if module.startswith('l10n_'):
-            result |= get_dependents(modules, module)
+            result |= graph.get_dependents(module)
     return result
 
 
@@ -31,11 +31,14 @@ class GitRun(object):
             git diff-index --name-only --cached {base_ref}
         :param base_ref: String of branch or sha base.
             e.g. "master" or "SHA_NUMBER"
-        :return: List of name of items changed
+        :return: List of name of items changed, or None if they can't be
+            known (e.g. base_ref not found)
         """
         command = ['diff-index', '--name-only',
                    '--cached', base_ref]
         res = self.run(command)
+        if res is None:
+            return None
         items = res.split('\n') if res else []
         return items
 
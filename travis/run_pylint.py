@@ -3,17 +3,21 @@
 
 from __future__ import print_function
 
-import ast
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import sys
 import inspect
+import tempfile
 
 import click
 import pylint.lint
 
 import travis_helpers
-from getaddons import get_modules_changed, is_module
+from getaddons import (
+    get_branch_base, get_modules_changed, is_module, read_manifest)
 from git_run import GitRun
 
 try:
@@ -21,8 +25,17 @@ try:
 except ImportError:
     import configparser as ConfigParser
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 CLICK_DIR = click.Path(exists=True, dir_okay=True, resolve_path=True)
 
+# Messages whose result depends on other modules than the one checked
+CROSS_MODULE_MSGS = (
+    'import-error', 'missing-import-error', 'missing-manifest-dependency')
+
 
 def get_extra_params(odoo_version):
     """Get extra pylint params by odoo version
@@ -102,14 +115,53 @@ def get_beta_msgs():
         'cfg/travis_run_pylint_beta.cfg')
     if not os.path.isfile(beta_cfg):
         return []
-    config = ConfigParser.ConfigParser()
-    config.readfp(open(beta_cfg))
+    return get_enabled_msgs(beta_cfg)
+
+
+def get_enabled_msgs(rcfile):
+    """Get the messages enabled in a pylint configuration file
+    :param rcfile: Path of the pylint configuration file
+    :return: List of strings with message names"""
+    config = ConfigParser.RawConfigParser()
+    config.read(rcfile)
+    if not config.has_option('MESSAGES CONTROL', 'enable'):
+        return []
     return [
         msg.strip()
         for msg in config.get('MESSAGES CONTROL', 'enable').split(',')
         if msg.strip()]
 
 
+def write_union_config(rcfile, rcfile_pr):
+    """Write a pylint configuration file enabling the messages of both
+    configuration files, to check the modules changed in a single run.
+    The options of `rcfile_pr` (e.g. the ODOOLINT ones) overwrite the ones
+    of `rcfile`, they are only used by the messages of pull requests.
+    :param rcfile: Path of the global pylint configuration file
+    :param rcfile_pr: Path of the pull request pylint configuration file
+    :return: Path of the temporary configuration file written
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(rcfile)
+    config_pr = ConfigParser.RawConfigParser()
+    config_pr.read(rcfile_pr)
+    for section in config_pr.sections():
+        if section == 'MESSAGES CONTROL':
+            continue
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in config_pr.items(section):
+            config.set(section, option, value)
+    msgs = get_enabled_msgs(rcfile)
+    msgs.extend(msg for msg in get_enabled_msgs(rcfile_pr)
+                if msg not in msgs)
+    config.set('MESSAGES CONTROL', 'enable', ','.join(msgs))
+    fd, fname = tempfile.mkstemp(prefix='pylint_', suffix='.cfg')
+    with os.fdopen(fd, 'w') as fobj:
+        config.write(fobj)
+    return fname
+
+
 def get_modules_cmd(dir):
     modules_cmd = []
     include_lint = os.environ.get('INCLUDE_LINT')
@@ -136,13 +188,6 @@ def version_validate(version, dir):
     return version
 
 
-def get_branch_base():
-    branch_base = os.environ.get('TRAVIS_BRANCH') or os.environ.get('VERSION')
-    if branch_base != 'HEAD':
-        branch_base = 'origin/' + (branch_base and branch_base or '')
-    return branch_base
-
-
 def pylint_run(is_pr, version, dir):
     # Look for an environment variable
     # whose value is the name of a proper configuration file for pylint
@@ -163,50 +208,96 @@ def pylint_run(is_pr, version, dir):
     extra_params_cmd = get_extra_params(odoo_version)
     extra_info = "extra_params_cmd %s " % extra_params_cmd
     print(extra_info)
-    conf = ["--config-file=%s" % (pylint_rcfile)]
-    cmd = conf + modules_cmd + extra_params_cmd
-
-    real_errors = main(cmd, standalone_mode=False)
+    modules_changed = []
+    if is_pr:
+        modules_changed = [os.path.realpath(module) for module in
+                           get_modules_changed(dir, branch_base)]
+        if modules_changed:
+            # Check the modules changed once, with the messages of both
+            # configuration files, and the other ones with the global one
+            modules_cmd = []
+            paths = [os.path.realpath(path)
+                     for path in get_modules_cmd(dir)[1::2]]
+            for module in get_subpaths(paths):
+                if module not in modules_changed:
+                    modules_cmd.extend(['--path', module])
+    real_errors = {}
+    if modules_cmd:
+        conf = ["--config-file=%s" % (pylint_rcfile)]
+        cmd = conf + modules_cmd + extra_params_cmd
+        real_errors = main(cmd, standalone_mode=False)
     res = dict(
         (key, value) for key, value in (real_errors.get(
             'by_msg') or {}).items() if key not in beta_msgs)
-    count_errors = get_count_fails(real_errors, list(beta_msgs))
-    count_info = "count_errors %s" % count_errors
-    print(count_info)
-    if is_pr:
+    if not is_pr or not modules_changed:
+        count_errors = get_count_fails(real_errors, list(beta_msgs))
+        print("count_errors %s" % count_errors)
+    if not is_pr:
+        return res
+    print(travis_helpers.green(
+        'Starting lint check only for modules changed'))
+    if not modules_changed:
         print(travis_helpers.green(
-            'Starting lint check only for modules changed'))
-        modules_changed = get_modules_changed(dir, branch_base)
-        if not modules_changed:
-            print(travis_helpers.green(
-                'There are not modules changed from '
-                '"git --git-dir=%s diff ..%s"' % (dir, branch_base)))
-            return res
-        modules_changed_cmd = []
-        for module_changed in modules_changed:
-            modules_changed_cmd.extend(['--path', module_changed])
-        conf = ["--config-file=%s" % (pylint_rcfile_pr)]
+            'There are not modules changed from '
+            '"git --git-dir=%s diff ..%s"' % (dir, branch_base)))
+        return res
+    modules_changed_cmd = []
+    for module_changed in modules_changed:
+        modules_changed_cmd.extend(['--path', module_changed])
+    union_rcfile = write_union_config(pylint_rcfile, pylint_rcfile_pr)
+    try:
+        conf = ["--config-file=%s" % (union_rcfile)]
         cmd = conf + modules_changed_cmd + extra_params_cmd
-        pr_real_errors = main(cmd, standalone_mode=False)
-        pr_stats = dict(
-            (key, value) for key, value in (pr_real_errors.get(
-                'by_msg') or {}).items() if key not in beta_msgs)
-        if pr_stats:
-            pr_errors = get_count_fails(pr_real_errors, list(beta_msgs))
-            print(travis_helpers.yellow(
-                "Found %s errors in modules changed." % (pr_errors)))
-            if pr_errors < 0:
-                res = pr_stats
-            else:
-                new_dict = {}
-                for val in res:
-                    new_dict[val] = (new_dict.get(val, 0) + res[val])
-                for val in pr_stats:
-                    new_dict[val] = (new_dict.get(val, 0) + pr_stats[val])
-                res = new_dict
+        changed_errors = main(cmd, standalone_mode=False)
+    finally:
+        os.remove(union_rcfile)
+    # The configuration of the modules changed has the options of both
+    # files, its messages replace the ones of the global configuration
+    for key, value in (real_errors.get('config_by_msg') or {}).items():
+        if key in res:
+            res[key] -= value
+            if not res[key]:
+                del res[key]
+    global_stats, pr_stats = split_changed_msgs(
+        changed_errors, get_enabled_msgs(pylint_rcfile),
+        get_enabled_msgs(pylint_rcfile_pr))
+    for key, value in global_stats.items():
+        if key not in beta_msgs:
+            res[key] = res.get(key, 0) + value
+    pr_stats = dict((key, value) for key, value in pr_stats.items()
+                    if key not in beta_msgs)
+    print("count_errors %s" % sum(res.values()))
+    if pr_stats:
+        pr_errors = sum(pr_stats.values())
+        print(travis_helpers.yellow(
+            "Found %s errors in modules changed." % (pr_errors)))
+        for key, value in pr_stats.items():
+            res[key] = res.get(key, 0) + value
     return res
 
 
+def split_changed_msgs(stats, global_msgs, pr_msgs):
+    """Split the messages found in the modules changed, checked once with the
+    messages of both configuration files, between the global and the pull
+    request counts. A message is counted in the count of each file enabling
+    it, and only in the global count if no file enables it (the messages
+    pylint emits whatever the configuration, e.g. syntax-error, and the ones
+    about the configuration file).
+    :param stats: Dict with the linter stats of the modules changed
+    :param global_msgs: List of the messages enabled in the global file
+    :param pr_msgs: List of the messages enabled in the pull request file
+    :return: Tuple (dict with the global count of each message,
+                    dict with the pull request count of each message)
+    """
+    global_stats, pr_stats = {}, {}
+    for key, value in (stats.get('by_msg') or {}).items():
+        if key in pr_msgs:
+            pr_stats[key] = value
+        if key not in pr_msgs or key in global_msgs:
+            global_stats[key] = value
+    return global_stats, pr_stats
+
+
 def get_count_fails(linter_stats, msgs_no_count=None):
     """Verify the dictionary statistics to get number of errors.
     :param linter_stats: Dict of type pylint.lint.Run().linter.stats
@@ -224,7 +315,7 @@ def is_installable_module(path):
     otherwise the full path to the module's manifest"""
     manifest_path = is_module(path)
     if manifest_path:
-        manifest = ast.literal_eval(open(manifest_path).read())
+        manifest = read_manifest(manifest_path)
         if manifest.get('installable', True):
             return manifest_path
     return False
@@ -256,14 +347,259 @@ def get_subpaths(paths, depth=1):
     return subpaths
 
 
-def run_pylint(paths, cfg, beta_msgs=None, sys_paths=None, extra_params=None):
+def get_stats_by_msg(stats):
+    """Get the count of each message of the stats of a linter
+    :param stats: Stats object of pylint>2.12 or dict
+    :return: Dict with the count of each message
+    """
+    if hasattr(stats, 'by_msg'):
+        return stats.by_msg
+    return stats.get('by_msg') or {}
+
+
+class ConfigMsgsLinter(getattr(pylint.lint.Run, 'LinterClass',
+                               pylint.lint.PyLinter)):
+    """Linter counting apart the messages about the configuration instead
+    of a module (e.g. unknown-option-value of the rcfile). They are emitted
+    by each pylint run, so they are counted once when the modules are
+    checked by several runs."""
+
+    def __init__(self, *args, **kwargs):
+        super(ConfigMsgsLinter, self).__init__(*args, **kwargs)
+        self.config_msgs = {}
+
+    def add_message(self, msgid, *args, **kwargs):
+        if (getattr(self, 'current_file', None) or '').endswith('.py'):
+            return super(ConfigMsgsLinter, self).add_message(
+                msgid, *args, **kwargs)
+        before = dict(get_stats_by_msg(self.stats))
+        res = super(ConfigMsgsLinter, self).add_message(
+            msgid, *args, **kwargs)
+        for msg, count in get_stats_by_msg(self.stats).items():
+            if count != before.get(msg, 0):
+                self.config_msgs[msg] = (self.config_msgs.get(msg, 0) +
+                                         count - before.get(msg, 0))
+        return res
+
+
+class ConfigMsgsRun(pylint.lint.Run):
+    """Run of pylint using `ConfigMsgsLinter`, only on the versions of
+    pylint having the `LinterClass` attribute"""
+    LinterClass = ConfigMsgsLinter
+
+
+def pylint_lint_run(cmd):
+    """Run pylint without exiting
+    :param cmd: List with the pylint command arguments
+    :return: Dict with python linter stats, the messages about the
+        configuration are counted in `by_msg` and in `config_by_msg`
+    """
+    if 'do_exit' in inspect.getargspec(pylint.lint.Run.__init__)[0]:
+        # pylint has renamed this keyword argument
+        pylint_res = ConfigMsgsRun(cmd, do_exit=False)
+    else:
+        pylint_res = ConfigMsgsRun(cmd, exit=False)
+    if hasattr(pylint_res.linter.stats, 'by_msg'):
+        # pylint>2.12 compatibility
+        pylint_res.linter.stats = {'by_msg': pylint_res.linter.stats.by_msg}
+    pylint_res.linter.stats['config_by_msg'] = dict(
+        getattr(pylint_res.linter, 'config_msgs', {}))
+    return pylint_res.linter.stats
+
+
+def sum_shard_results(results):
+    """Sum the messages found by several pylint runs, counting the messages
+    about the configuration of the first run only, as a single run does.
+    :param results: List of the results of `run_pylint_shard`
+    :return: Dict with the count of each message
+    """
+    by_msg = {}
+    for index, (shard_by_msg, _, config_by_msg) in enumerate(results):
+        for msg, count in shard_by_msg.items():
+            if index:
+                count -= config_by_msg.get(msg, 0)
+            if count:
+                by_msg[msg] = by_msg.get(msg, 0) + count
+    return by_msg
+
+
+def run_pylint_shard(args):
+    """Run pylint on a shard of the modules, in a worker process
+    :param args: Tuple (pylint command arguments, sys paths to append)
+    :return: Tuple (dict of the messages count, string with the output,
+        dict of the count of the messages about the configuration)
+    """
+    cmd, sys_paths = args
+    sys.path.extend(path for path in sys_paths if path not in sys.path)
+    output, stdout = StringIO(), sys.stdout
+    sys.stdout = output
+    try:
+        stats = pylint_lint_run(cmd)
+    finally:
+        sys.stdout = stdout
+    return (dict(stats.get('by_msg') or {}), output.getvalue(),
+            stats['config_by_msg'])
+
+
+def map_pylint_shards(shards, jobs=1):
+    """Run pylint on each shard, in `jobs` worker processes
+    :param shards: List of arguments of `run_pylint_shard`
+    :param jobs: Number of processes
+    :return: List of the results of `run_pylint_shard`, in order
+    """
+    jobs = min(jobs, len(shards))
+    if jobs <= 1:
+        return [run_pylint_shard(shard) for shard in shards]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(run_pylint_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_installed_distributions():
+    """Get the python packages installed, the result of messages like
+    import-error depends on them
+    :return: Sorted list of strings `name==version`"""
+    try:
+        import pkg_resources
+        return sorted('%s==%s' % (dist.project_name, dist.version)
+                      for dist in pkg_resources.working_set)
+    except ImportError:
+        from importlib import metadata
+        return sorted('%s==%s' % (dist.metadata['Name'], dist.version)
+                      for dist in metadata.distributions())
+
+
+def get_cache_salt(cfg, subpaths, sys_paths, extra_params):
+    """Get the part of the cache key shared by all the modules checked:
+    python version, python packages installed (pylint and pylint-odoo
+    included), configuration file contents and extra params. If a message of
+    `CROSS_MODULE_MSGS` is enabled, the names of all the modules with their
+    dependencies are added too: these messages only depend on them, so
+    other changes of the manifests (e.g. their version) keep the results.
+    :return: String with the hash
+    """
+    hasher = hashlib.sha1()
+    for item in [sys.version] + get_installed_distributions():
+        hasher.update(item.encode('utf-8'))
+    with open(cfg, 'rb') as fobj:
+        hasher.update(fobj.read())
+    for item in list(sys_paths) + list(extra_params):
+        hasher.update(item.encode('utf-8'))
+    enabled = set(get_enabled_msgs(cfg))
+    for param in extra_params:
+        if param.startswith('--enable='):
+            enabled.update(param[len('--enable='):].split(','))
+    if 'all' in enabled or enabled.intersection(CROSS_MODULE_MSGS):
+        for path in sorted(subpaths):
+            manifest = read_manifest(is_module(path))
+            hasher.update(json.dumps([
+                os.path.basename(os.path.normpath(path)),
+                manifest.get('depends', []),
+                manifest.get('external_dependencies', {}),
+            ], sort_keys=True, default=sorted).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def get_cache_key(path, salt):
+    """Get the cache key of the results of a module: hash of the path and
+    the contents of its files, and the salt of `get_cache_salt`
+    :return: String with the hash
+    """
+    hasher = hashlib.sha1(salt.encode('utf-8'))
+    hasher.update(path.encode('utf-8'))
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(item for item in dirs
+                         if item not in ('.git', '__pycache__'))
+        for fname in sorted(files):
+            if fname.endswith(('.pyc', '.pyo')):
+                continue
+            fpath = os.path.join(root, fname)
+            hasher.update(os.path.relpath(fpath, path).encode('utf-8'))
+            with open(fpath, 'rb') as fobj:
+                hasher.update(fobj.read())
+    return hasher.hexdigest()
+
+
+def write_json(fname, data):
+    """Write a file of the cache atomically, for the builds reading it
+    at the same time (or writing it, with their own temporary file)"""
+    tmp_fname = '%s.%d' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as fobj:
+        json.dump(data, fobj)
+    os.rename(tmp_fname, fname)
+
+
+def run_pylint_cached(cmd, subpaths, cache_dir, salt, sys_paths, jobs=1):
+    """Run pylint on each module not found in the cache directory, and
+    store its results. The modules are checked one by one to know the
+    results of each one. The messages about the configuration are stored
+    apart, to be counted once.
+    :return: Dict with python linter stats
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cache_files = dict(
+        (path, os.path.join(cache_dir, get_cache_key(path, salt) + '.json'))
+        for path in subpaths)
+    results = {}
+    for path in subpaths:
+        try:
+            with open(cache_files[path]) as fobj:
+                results[path] = tuple(json.load(fobj))
+        except (IOError, OSError, ValueError):
+            pass
+    config_file = os.path.join(cache_dir, salt + '.config.json')
+    try:
+        with open(config_file) as fobj:
+            config_by_msg = json.load(fobj)
+    except (IOError, OSError, ValueError):
+        # They are known by checking a module again
+        config_by_msg = None
+        if len(results) == len(subpaths):
+            del results[subpaths[0]]
+    pending = [path for path in subpaths if path not in results]
+    shards = [(cmd + [path], list(sys_paths)) for path in pending]
+    for path, (module_by_msg, output, shard_config_by_msg) in zip(
+            pending, map_pylint_shards(shards, jobs)):
+        for msg, count in shard_config_by_msg.items():
+            module_by_msg[msg] -= count
+        results[path] = (
+            dict((msg, count) for msg, count in module_by_msg.items()
+                 if count),
+            output)
+        write_json(cache_files[path], results[path])
+        if config_by_msg is None:
+            config_by_msg = shard_config_by_msg
+            write_json(config_file, config_by_msg)
+    print("pylint results of %s modules reused from %s" % (
+        len(subpaths) - len(pending), cache_dir))
+    by_msg = dict(config_by_msg)
+    for path in subpaths:
+        module_by_msg, output = results[path]
+        sys.stdout.write(output)
+        for msg, count in module_by_msg.items():
+            by_msg[msg] = by_msg.get(msg, 0) + count
+    return {'by_msg': by_msg, 'config_by_msg': dict(config_by_msg)}
+
+
+def run_pylint(paths, cfg, beta_msgs=None, sys_paths=None, extra_params=None,
+               jobs=1, cache_dir=None):
     """Execute pylint command from original python library
     :param paths: List of paths of python modules to check with pylint
     :param cfg: String name of pylint configuration file
     :param sys_paths: List of paths to append to sys path
     :param extra_params: List of extra parameters to append
         in pylint command
-    :return: Dict with python linter stats
+    :param jobs: Number of processes checking the modules, each one with a
+        shard of the modules. The checks of pylint-odoo are per module,
+        so the messages found are the same.
+    :param cache_dir: Directory to reuse the results of the modules not
+        changed from previous runs
+    :return: Dict with python linter stats, the messages about the
+        configuration counted in `by_msg` and in `config_by_msg`
     """
     if sys_paths is None:
         sys_paths = []
@@ -280,16 +616,21 @@ def run_pylint(paths, cfg, beta_msgs=None, sys_paths=None, extra_params=None):
                 if os.path.basename(path) not in exclude]
     if not subpaths:
         return {'error': 0}
-    cmd.extend(subpaths)
-    if 'do_exit' in inspect.getargspec(pylint.lint.Run.__init__)[0]:
-        # pylint has renamed this keyword argument
-        pylint_res = pylint.lint.Run(cmd, do_exit=False)
-    else:
-        pylint_res = pylint.lint.Run(cmd, exit=False)
-    if hasattr(pylint_res.linter.stats, 'by_msg'):
-        # pylint>2.12 compatibility
-        pylint_res.linter.stats = {'by_msg': pylint_res.linter.stats.by_msg}
-    return pylint_res.linter.stats
+    if cache_dir:
+        salt = get_cache_salt(cfg, subpaths, sys_paths, extra_params)
+        return run_pylint_cached(
+            cmd, subpaths, cache_dir, salt, sys_paths, jobs=jobs)
+    jobs = min(jobs, len(subpaths))
+    if jobs <= 1:
+        cmd.extend(subpaths)
+        return pylint_lint_run(cmd)
+    shards = [(cmd + subpaths[job::jobs], list(sys_paths))
+              for job in range(jobs)]
+    results = map_pylint_shards(shards, jobs)
+    for _, output, _ in results:
+        sys.stdout.write(output)
+    return {'by_msg': sum_shard_results(results),
+            'config_by_msg': dict(results[0][2])}
 
 
 @click.command()
@@ -308,8 +649,14 @@ def run_pylint(paths, cfg, beta_msgs=None, sys_paths=None, extra_params=None):
                    "in pylint command")
 @click.option('--msgs-no-count', '-msgs-no-count', multiple=True,
               help="List of messages that will not add to the failure count.")
+@click.option('--jobs', '-j', envvar='MQT_PYLINT_JOBS', type=int, default=1,
+              help="Number of processes checking shards of the modules.")
+@click.option('--cache-dir', envvar='MQT_PYLINT_CACHE',
+              type=click.Path(file_okay=False, resolve_path=True),
+              help="Directory to reuse the results of the modules "
+                   "not changed from previous runs.")
 def main(paths, config_file, msgs_no_count=None,
-         sys_paths=None, extra_params=None):
+         sys_paths=None, extra_params=None, jobs=1, cache_dir=None):
     """Script to run pylint command with additional params
     to check fails of odoo modules.
     If expected errors is equal to count fails found then
@@ -318,7 +665,8 @@ def main(paths, config_file, msgs_no_count=None,
         stats = run_pylint(
             list(paths), config_file.name,
             sys_paths=sys_paths,
-            extra_params=extra_params)
+            extra_params=extra_params,
+            jobs=jobs, cache_dir=cache_dir)
     except UserWarning:
         stats = {'error': -1}
     return stats
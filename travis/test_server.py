@@ -1,107 +1,257 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
+
+import contextlib
+import fcntl
+import hashlib
+import itertools
 import re
 import os
 import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 from six import string_types
+from six.moves import queue
 from getaddons import (
-    get_addons, get_modules, get_modules_info, get_dependencies)
-from travis_helpers import success_msg, fail_msg
+    ModuleGraph, get_addons, get_branch_base, get_items_changed, get_modules,
+    get_modules_info, is_module)
+from fork_server import ForkServer, is_supported as fork_server_supported
+from git_run import GitRun
+from travis_helpers import success_msg, fail_msg, stream_file
 try:
     import ConfigParser
 except ImportError:
     import configparser as ConfigParser
 
+_DEFAULT_REGEX_FLAGS = re.compile('').flags
 
-def has_test_errors(fname, dbname, odoo_version, check_loaded=True):
+
+class LogErrorChecker(object):
     """
-    Check a list of log lines for test errors.
+    Check the lines of an Odoo log for test errors while they are produced.
     Extension point to detect false positives.
+    Only the records matching the error rules are kept, so the memory used
+    doesn't depend on the size of the log.
     """
-    # Rules defining checks to perform
-    # this can be
-    # - a string which will be checked in a simple substring match
-    # - a regex object that will be matched against the whole message
-    # - a callable that receives a dictionary of the form
-    #     {
-    #         'loglevel': ...,
-    #         'message': ....,
-    #     }
-    errors_ignore = [
-        'Mail delivery failed',
-        'failed sending mail',
-        ]
-    errors_report = [
-        lambda x: x['loglevel'] == 'CRITICAL',
-        'At least one test failed',
-        'no access rules, consider adding one',
-        'invalid module names, ignored',
-        ]
-    # Only check ERROR lines before 7.0
-    if odoo_version < '7.0':
-        errors_report.append(
-            lambda x: x['loglevel'] == 'ERROR')
-
-    def make_pattern_list_callable(pattern_list):
-        for i in range(len(pattern_list)):
-            if isinstance(pattern_list[i], string_types):
-                regex = re.compile(pattern_list[i])
-                pattern_list[i] = lambda x, regex=regex:\
-                    regex.search(x['message'])
-            elif hasattr(pattern_list[i], 'match'):
-                regex = pattern_list[i]
-                pattern_list[i] = lambda x, regex=regex:\
-                    regex.search(x['message'])
-
-    make_pattern_list_callable(errors_ignore)
-    make_pattern_list_callable(errors_report)
-
-    print("-"*10)
-    # Read log file removing ASCII color escapes:
+    # ASCII color escapes to remove from the lines:
     # http://serverfault.com/questions/71285
     color_regex = re.compile(r'\x1B\[([0-9]{1,2}(;[0-9]{1,2})?)?[m|K]')
-    log_start_regex = re.compile(
-        r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} \d+ (?P<loglevel>\w+) '
-        '(?P<db>(%s)|([?])) (?P<logger>\S+): (?P<message>.*\S)\s*$' % dbname)
-    log_records = []
-    last_log_record = dict.fromkeys(log_start_regex.groupindex.keys())
-    with open(fname) as log:
-        for line in log:
-            line = color_regex.sub('', line)
-            match = log_start_regex.match(line)
-            if match:
-                last_log_record = match.groupdict()
-                log_records.append(last_log_record)
+    # Levels of the records logged by a server with --log-level=warn
+    warn_loglevels = ('WARNING', 'ERROR', 'CRITICAL')
+
+    def __init__(self, dbname, odoo_version, check_loaded=True,
+                 test_start=None):
+        # Rules defining checks to perform
+        # this can be
+        # - a string which will be checked in a simple substring match
+        # - a regex object that will be matched against the whole message
+        # - a callable that receives a dictionary of the form
+        #     {
+        #         'loglevel': ...,
+        #         'message': ....,
+        #     }
+        self.errors_ignore = [
+            'Mail delivery failed',
+            'failed sending mail',
+            ]
+        self.errors_report = [
+            lambda x: x['loglevel'] == 'CRITICAL',
+            'At least one test failed',
+            'no access rules, consider adding one',
+            'invalid module names, ignored',
+            ]
+        # Only check ERROR lines before 7.0
+        if odoo_version < '7.0':
+            self.errors_report.append(
+                lambda x: x['loglevel'] == 'ERROR')
+        self.ignore_rules = self.compile_rules(self.errors_ignore)
+        self.report_rules = self.compile_rules(self.errors_report)
+        self.log_start_regex = re.compile(
+            r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} \d+ '
+            r'(?P<loglevel>\w+) (?P<db>(%s)|([?])) (?P<logger>\S+): '
+            r'(?P<message>.*\S)\s*$' % dbname)
+        self.check_loaded = check_loaded
+        self.modules_loaded = False
+        # Log of an install and a test in the same server: the records before
+        # the one matching test_start are checked like the ones of an install
+        # at warn level. Only the rules matching records below WARNING (e.g.
+        # added by a subclass) are affected: the default ones match WARNING
+        # or higher, so the install part is reported in full, like the
+        # output of a separate install command
+        self.test_start = test_start
+        self.testing = test_start is None
+        self.errors = []
+        self._record = None
+        self._record_lines = []
+
+    @staticmethod
+    def compile_rules(rules):
+        """Compile the string and regex rules into a single regex, so a log
+        record that doesn't match any of them is searched only once.
+        Non-capturing groups are used because named groups disable the
+        literal prefix optimizations of the regex engine; the rule that fired
+        is found afterwards, which is cheap since matches are rare.
+        The callable rules, and the regexes that can't be combined because
+        of their own groups or flags, are kept apart.
+        :param rules: List of rules (see __init__)
+        :return: Tuple (combined regex or None,
+                        list of tuples (rule, regex),
+                        list of tuples (rule, callable))
+        """
+        regexes = []
+        callables = []
+        for rule in rules:
+            if isinstance(rule, string_types):
+                regex = re.compile(rule)
+            elif hasattr(rule, 'match'):
+                regex = rule
             else:
-                last_log_record['message'] = '%s\n%s' % (
-                    last_log_record['message'], line.rstrip('\n')
-                )
-    errors = []
-    for log_record in log_records:
-        ignore = False
-        for ignore_pattern in errors_ignore:
-            if ignore_pattern(log_record):
-                ignore = True
-                break
-        if ignore:
-            continue
-        for report_pattern in errors_report:
-            if report_pattern(log_record):
-                errors.append(log_record)
-                break
+                callables.append((rule, rule))
+                continue
+            if regex.groups or regex.flags != _DEFAULT_REGEX_FLAGS:
+                callables.append((rule, lambda x, regex=regex:
+                                  regex.search(x['message'])))
+                continue
+            regexes.append((rule, regex))
+        combined = None
+        if regexes:
+            combined = re.compile('|'.join(
+                '(?:%s)' % regex.pattern for rule, regex in regexes))
+        return combined, regexes, callables
+
+    @staticmethod
+    def match_rule(compiled_rules, log_record):
+        """Get the rule matching the log record
+        :param compiled_rules: Tuple returned by compile_rules
+        :param log_record: Dict with the log record
+        :return: The rule matching the log record or None
+        """
+        combined, regexes, callables = compiled_rules
+        if combined is not None and combined.search(log_record['message']):
+            for rule, regex in regexes:
+                if regex.search(log_record['message']):
+                    return rule
+        for rule, rule_callable in callables:
+            if rule_callable(log_record):
+                return rule
+        return None
+
+    def feed(self, line):
+        """Process one line of the log
+        :param line: String or bytes with the line, including line ending.
+        """
+        if isinstance(line, bytes):
+            line = line.decode('UTF-8', errors='backslashreplace')
+        line = self.color_regex.sub('', line)
+        match = self.log_start_regex.match(line)
+        if match:
+            self._check_record()
+            self._record = match.groupdict()
+        elif self._record is not None:
+            # Continuation of a multi-line message (e.g. a traceback)
+            self._record_lines.append(line.rstrip('\n'))
+
+    def _check_record(self):
+        """Apply the rules on the current log record and forget it
+        unless it is an error."""
+        log_record = self._record
+        if log_record is None:
+            return
+        if self._record_lines:
+            log_record['message'] = '\n'.join(
+                [log_record['message']] + self._record_lines)
+        self._record = None
+        self._record_lines = []
+        if 'Modules loaded.' in log_record['message']:
+            self.modules_loaded = True
+        if not self.testing:
+            if self.test_start.search(log_record['message']):
+                self.testing = True
+            elif log_record['loglevel'] not in self.warn_loglevels:
+                return
+        if self.match_rule(self.ignore_rules, log_record) is not None:
+            return
+        rule = self.match_rule(self.report_rules, log_record)
+        if rule is not None:
+            log_record['rule'] = rule
+            self.errors.append(log_record)
 
-    if check_loaded:
-        if not [r for r in log_records if 'Modules loaded.' in r['message']]:
+    def report(self, echo=print):
+        """Print the errors found in the lines processed
+        :param echo: Function used to print
+        :return: Integer with the number of errors found
+        """
+        self._check_record()
+        errors = list(self.errors)
+        if self.check_loaded and not self.modules_loaded:
             errors.append({'message': "Message not found: 'Modules loaded.'"})
+        echo("-"*10)
+        if errors:
+            for e in errors:
+                echo(e['message'])
+            echo("-"*10)
+        return len(errors)
 
-    if errors:
-        for e in errors:
-            print(e['message'])
-        print("-"*10)
-    return len(errors)
+
+def has_test_errors(fname, dbname, odoo_version, check_loaded=True):
+    """
+    Check a log file for test errors.
+    See LogErrorChecker to check the lines while they are produced.
+    """
+    checker = LogErrorChecker(dbname, odoo_version, check_loaded)
+    with open(fname) as log:
+        for line in log:
+            checker.feed(line)
+    return checker.report()
+
+
+def get_test_start(module):
+    """Regex of the first log message of the installation of a module,
+    when its data files are loaded, before its tests
+    :param module: Name of the module
+    :return: Compiled regex matching the message
+    """
+    return re.compile(r'^(module %(module)s: |loading %(module)s/)' % {
+        'module': re.escape(module)})
+
+
+def get_test_args(database, test_loglevel, test_loghandler, options,
+                  single_run_options=None, to_test=None):
+    """Get the arguments of the server testing the modules to install
+    :param single_run_options: Options of the installation of the modules,
+        when the same server installs and tests them (MQT_SINGLE_RUN). They
+        are given before the test ones, so that these are the ones used when
+        both are given (e.g. --log-level, optparse keeps the last one).
+    :param to_test: Module whose tests are selected with --test-tags
+        (MQT_SINGLE_RUN)
+    :return: List of arguments
+    """
+    args = ["-d", database, "--db-filter=^%s$" % database,
+            "--stop-after-init"] + (single_run_options or []) + [
+            "--log-level", test_loglevel]
+    if test_loghandler is not None:
+        args += ['--log-handler', test_loghandler]
+    args += options
+    if to_test is not None:
+        args += ["--test-tags", "/" + to_test]
+    return args
+
+
+def get_version_major(odoo_version):
+    """
+    :param odoo_version: Odoo version, e.g. '12.0'
+    :return: Integer with the major version, None if it is not a number
+    """
+    try:
+        return int(odoo_version.split('.')[0])
+    except ValueError:
+        return None
 
 
 def parse_list(comma_sep_list):
@@ -169,6 +319,45 @@ def get_addons_to_check(travis_build_dir, odoo_include, odoo_exclude):
     return addons_list
 
 
+def get_addons_changed(travis_build_dir, addons_list, ref):
+    """
+    Get the modules to test in a pull request: the modules changed and
+    the modules of the repository that depend on them.
+    :param travis_build_dir: Travis build directory
+    :param addons_list: List of the modules that can be tested
+    :param ref: Branch or sha to compare with
+    :return: List of the modules to test. All of addons_list if the changes
+        can't be known or if files outside of the modules changed.
+    """
+    items_changed = get_items_changed(travis_build_dir, ref)
+    if items_changed is None:
+        print("Changes from %s not found, testing all the modules." % ref)
+        return addons_list
+    folders_changed = set()
+    for item_changed in items_changed:
+        folder = item_changed.split('/')[0]
+        # setup/ holds the setuptools-odoo packaging of the modules
+        if folder == 'setup' or (
+                '/' in item_changed and
+                is_module(os.path.join(travis_build_dir, folder))):
+            folders_changed.add(folder)
+        elif '/' in item_changed and get_modules(
+                os.path.join(travis_build_dir, folder)):
+            # The modules are only looked for at the root of the repository
+            print("Module in the subfolder %s changed (%s), not supported, "
+                  "testing all the modules." % (folder, item_changed))
+            return addons_list
+        else:
+            print("Repository file %s changed, testing all the modules."
+                  % item_changed)
+            return addons_list
+    graph = ModuleGraph(get_modules_info(travis_build_dir))
+    to_test = set()
+    for module in folders_changed:
+        to_test |= graph.get_dependents(module)
+    return [module for module in addons_list if module in to_test]
+
+
 def get_test_dependencies(addons_path, addons_list):
     """
     Get the list of core and external modules dependencies
@@ -182,9 +371,10 @@ def get_test_dependencies(addons_path, addons_list):
         modules = {}
         for path in addons_path.split(','):
             modules.update(get_modules_info(path))
+        graph = ModuleGraph(modules)
         dependencies = set()
         for module in addons_list:
-            dependencies |= get_dependencies(modules, module)
+            dependencies |= graph.get_dependencies(module)
         return list(dependencies - set(addons_list))
 
 
@@ -251,6 +441,153 @@ def setup_server(db, odoo_unittest, tested_addons, server_path, script_name,
     return 0
 
 
+@contextlib.contextmanager
+def template_lock(db):
+    """
+    Lock the creation of a template database, so other processes testing
+    at the same time (e.g. the combinations of MQT_MATRIX) wait for it
+    instead of using it while it is created.
+    :param db: Template database name
+    """
+    fname = os.path.join(tempfile.gettempdir(), 'mqt_%s.lock' % db)
+    with open(fname, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_template_hash(server_path, addons_path, preinstall_modules,
+                      options=None):
+    """
+    Computes a hash of what makes the content of the template database:
+    the commit of the server, the modules preinstalled with their manifests
+    (so their versions) and the options of the server.
+    :param server_path: Server path
+    :param addons_path: Addons path
+    :param preinstall_modules: (list) Modules preinstalled in the template
+    :param options: (list) Options of the server to install the modules
+    :return: String with the hexadecimal hash, None if the commit of the
+        server is unknown (e.g. not a git repository)
+    """
+    digest = hashlib.sha1()
+
+    def update(value):
+        digest.update(value.encode('UTF-8') + b'\0')
+
+    commit = GitRun(os.path.join(server_path, '.git')).run(
+        ['rev-parse', 'HEAD'])
+    if not commit:
+        return None
+    update(commit)
+    for option in options or []:
+        update(option)
+    modules_left = set(preinstall_modules)
+    for module in sorted(modules_left):
+        update(module)
+    for path in addons_path.split(','):
+        for module in get_modules(path):
+            if module not in modules_left:
+                continue
+            # Like the server, use the first module found in the addons path
+            modules_left.remove(module)
+            manifest_path = is_module(os.path.join(path, module))
+            update(module)
+            with open(manifest_path, 'rb') as manifest:
+                digest.update(manifest.read())
+    return digest.hexdigest()
+
+
+def get_preinstall_hash(preinstall_modules, options=None):
+    """
+    Computes a hash of the modules preinstalled in the template database
+    and of the options of the server installing them, without reading the
+    server nor the manifests (see get_template_hash).
+    :param preinstall_modules: (list) Modules preinstalled in the template
+    :param options: (list) Options of the server to install the modules
+    :return: String with the hexadecimal hash
+    """
+    digest = hashlib.sha1()
+    for value in list(options or []) + sorted(preinstall_modules):
+        digest.update(value.encode('UTF-8') + b'\0')
+    return digest.hexdigest()
+
+
+def get_template_cache_files(cache_dir, template_hash):
+    """
+    Computes the paths of the files of a template database in the cache
+    :param cache_dir: Directory of the cache
+    :param template_hash: Hash of the template (see get_template_hash)
+    :return: Tuple (database dump path, filestore archive path)
+    """
+    return (os.path.join(cache_dir, '%s.dump' % template_hash),
+            os.path.join(cache_dir, '%s.filestore.tar.gz' % template_hash))
+
+
+def restore_template(db, cache_dir, template_hash, data_dir):
+    """
+    Restore the template database and its filestore from the cache.
+    :param db: Template database name
+    :param cache_dir: Directory of the cache
+    :param template_hash: Hash of the template (see get_template_hash)
+    :param data_dir: Odoo data directory
+    :return: True if the template was restored from the cache
+    """
+    dump_fname, filestore_fname = get_template_cache_files(
+        cache_dir, template_hash)
+    if not os.path.isfile(dump_fname):
+        print("Template database %s not found in cache." % db)
+        return False
+    print("\nRestoring %s from cache %s" % (db, dump_fname))
+    if subprocess.call(["createdb", db]) != 0:
+        print("Using previous %s database." % db)
+        return True
+    if subprocess.call(["pg_restore", "--no-owner", "-d", db,
+                        dump_fname]) != 0:
+        print("Restore failed, the template database will be created.")
+        subprocess.call(["dropdb", db])
+        return False
+    if os.path.isfile(filestore_fname):
+        attach_dir = os.path.join(data_dir, 'filestore', db)
+        with tarfile.open(filestore_fname) as archive:
+            archive.extractall(attach_dir)
+    return True
+
+
+def store_template(db, cache_dir, template_hash, data_dir):
+    """
+    Store the template database and its filestore in the cache,
+    if it's not already there.
+    :param db: Template database name
+    :param cache_dir: Directory of the cache
+    :param template_hash: Hash of the template (see get_template_hash)
+    :param data_dir: Odoo data directory
+    """
+    dump_fname, filestore_fname = get_template_cache_files(
+        cache_dir, template_hash)
+    if os.path.isfile(dump_fname):
+        return
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    print("\nStoring %s in cache %s" % (db, dump_fname))
+    # Write in temporary files to never leave a partial dump in the cache,
+    # of each process as the combinations of a matrix can share templates
+    attach_dir = os.path.join(data_dir, 'filestore', db)
+    if os.path.isdir(attach_dir):
+        tmp_fname = '%s.%d' % (filestore_fname, os.getpid())
+        with tarfile.open(tmp_fname, 'w:gz') as archive:
+            archive.add(attach_dir, arcname='.')
+        os.rename(tmp_fname, filestore_fname)
+    tmp_fname = '%s.%d' % (dump_fname, os.getpid())
+    if subprocess.call(["pg_dump", "-Fc", "-f", tmp_fname, db]) != 0:
+        print("Dump of %s failed, not stored in cache." % db)
+        if os.path.isfile(tmp_fname):
+            os.remove(tmp_fname)
+        return
+    os.rename(tmp_fname, dump_fname)
+
+
 def run_from_env_var(env_name_startswith, environ):
     """Method to run a script defined from an environment variable
     :param env_name_startswith: String with name of first letter of
@@ -271,27 +608,203 @@ def create_server_conf(data, version):
     """Create (or edit) default configuration file of odoo
     :params data: Dict with all info to save in file"""
     fname_conf = os.path.expanduser('~/.openerp_serverrc')
-    if not os.path.exists(fname_conf):
-        # If not exists the file then is created
-        fconf = open(fname_conf, "w")
-        fconf.close()
     config = ConfigParser.ConfigParser()
     config.read(fname_conf)
     if not config.has_section('options'):
         config.add_section('options')
     for key, value in data.items():
         config.set('options', key, value)
-    with open(fname_conf, 'w') as configfile:
+    # Replaced at once, other processes testing can be reading it,
+    # or writing it too with their own temporary file
+    tmp_fname = '%s.%d' % (fname_conf, os.getpid())
+    with open(tmp_fname, 'w') as configfile:
         config.write(configfile)
+    os.rename(tmp_fname, fname_conf)
+
+
+def clone_tree(src, dst):
+    """Copy a directory tree without copying the data of its files,
+    using reflinks (copy-on-write) if the filesystem supports them,
+    or hardlinks otherwise.
+    This is only safe if the files are never modified in place,
+    as Odoo does with the files of its filestore: they are named by the
+    checksum of their content, so it writes new files instead.
+    :param src: Path of the directory to copy
+    :param dst: Path of the copy, that must not exist
+    """
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(['cp', '-r', '--reflink=always', src, dst],
+                           stdout=devnull, stderr=devnull) == 0:
+            return
+    shutil.rmtree(dst, ignore_errors=True)
+    try:
+        for root, dirs, files in os.walk(src):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(dst_root)
+            for fname in files:
+                os.link(os.path.join(root, fname),
+                        os.path.join(dst_root, fname))
+    except OSError:
+        # e.g. hardlinks not supported
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst)
 
 
-def copy_attachments(dbtemplate, dbdest, data_dir):
+def copy_attachments(dbtemplate, dbdest, data_dir, clone=False):
+    """Copy the filestore of the template database to the database dbdest
+    :param clone: Use clone_tree instead of copying the files
+    """
     attach_dir = os.path.join(os.path.expanduser(data_dir), 'filestore')
     attach_tmpl_dir = os.path.join(attach_dir, dbtemplate)
     attach_dest_dir = os.path.join(attach_dir, dbdest)
     if os.path.isdir(attach_tmpl_dir) and not os.path.isdir(attach_dest_dir):
-        print("copy", attach_tmpl_dir, attach_dest_dir)
-        shutil.copytree(attach_tmpl_dir, attach_dest_dir)
+        if clone:
+            print("clone", attach_tmpl_dir, attach_dest_dir)
+            clone_tree(attach_tmpl_dir, attach_dest_dir)
+        else:
+            print("copy", attach_tmpl_dir, attach_dest_dir)
+            shutil.copytree(attach_tmpl_dir, attach_dest_dir)
+
+
+class DatabasePool(object):
+    """
+    Copies of a template database, with its filestore, to test the modules.
+    With a size, up to size copies are made in the background before they
+    are needed, and the databases released are dropped in the background,
+    so createdb and dropdb are not waited for between the modules.
+    Without size, the copies are made and dropped when asked.
+    """
+
+    def __init__(self, dbtemplate, prefix, data_dir, size=0, limit=None,
+                 clone_filestore=False):
+        """
+        :param dbtemplate: Name of the template database
+        :param prefix: Prefix of the names of the copies
+        :param data_dir: Odoo data directory, holding the filestores
+        :param size: Number of copies to keep ready
+        :param limit: Number of copies that will be asked, so no more copies
+            than needed are made in the background
+        :param clone_filestore: Clone the filestore (see clone_tree)
+            instead of copying it
+        """
+        self.dbtemplate = dbtemplate
+        self.prefix = prefix
+        self.data_dir = data_dir
+        self.clone_filestore = clone_filestore
+        self.size = size
+        self.limit = limit
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._ready = queue.Queue()
+        self._released = queue.Queue()
+        self._free_slots = threading.Semaphore(size)
+        self._closed = False
+        self._threads = []
+        if size:
+            for target in (self._create_ahead, self._drop_released):
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def create(self):
+        """Create a copy of the template database and its filestore
+        Raises CalledProcessError if createdb fails, or OSError if the
+        filestore can't be copied.
+        :return: String with the name of the new database
+        """
+        with self._lock:
+            database = '%s_%d' % (self.prefix, next(self._counter))
+        try:
+            subprocess.check_call(
+                ["createdb", "-T", self.dbtemplate, database])
+            copy_attachments(self.dbtemplate, database, self.data_dir,
+                             self.clone_filestore)
+        except Exception:
+            self.drop(database)
+            raise
+        return database
+
+    def drop(self, database):
+        """Drop a database and its filestore"""
+        subprocess.call(["dropdb", database])
+        shutil.rmtree(
+            os.path.join(self.data_dir, 'filestore', database),
+            ignore_errors=True)
+
+    def _create_ahead(self):
+        created = 0
+        while self.limit is None or created < self.limit:
+            self._free_slots.acquire()
+            if self._closed:
+                break
+            try:
+                self._ready.put(self.create())
+            except Exception as e:
+                # Raised by get, instead of waiting forever for the copy
+                self._ready.put(e)
+            created += 1
+
+    def _drop_released(self):
+        for database in iter(self._released.get, None):
+            self.drop(database)
+
+    def get(self):
+        """Get a copy of the template, waiting for it if needed. Raises the
+        error of the copy (see create) if it failed.
+        :return: String with the name of the database
+        """
+        if not self.size:
+            return self.create()
+        database = self._ready.get()
+        self._free_slots.release()
+        if isinstance(database, Exception):
+            raise database
+        return database
+
+    def release(self, database):
+        """Give back a database that is not needed anymore, to drop it"""
+        if not self.size:
+            self.drop(database)
+        else:
+            self._released.put(database)
+
+    def close(self):
+        """Stop making copies, drop the ones not used
+        and wait for all the databases released to be dropped"""
+        if not self.size:
+            return
+        self._closed = True
+        self._free_slots.release()
+        creator, dropper = self._threads
+        creator.join()
+        while not self._ready.empty():
+            database = self._ready.get()
+            if not isinstance(database, Exception):
+                self._released.put(database)
+        self._released.put(None)
+        dropper.join()
+
+
+def run_command(command_call, log, checker, verbose=True):
+    """Run a server command, writing its output in the log file and feeding
+    the log error checker with it.
+    :param command_call: List with the command to run
+    :param log: File opened in binary mode where the output is written
+    :param checker: LogErrorChecker of the command
+    :param verbose: Print the output of the command while it is produced
+    :return: Integer with the return code of the command
+    """
+    pipe = subprocess.Popen(command_call,
+                            stderr=subprocess.STDOUT,
+                            stdout=subprocess.PIPE)
+    for line in iter(pipe.stdout.readline, b''):
+        log.write(line)
+        line = line.decode('UTF-8', errors='backslashreplace')
+        if verbose:
+            print(line.strip())
+        checker.feed(line)
+    return pipe.wait()
 
 
 def main(argv=None):
@@ -315,7 +828,9 @@ def main(argv=None):
     data_dir = os.path.expanduser(os.environ.get("DATA_DIR", '~/data_dir'))
     test_enable = str2bool(os.environ.get('TEST_ENABLE', True))
     dbtemplate = os.environ.get('MQT_TEMPLATE_DB', 'openerp_template')
+    clone_filestore = str2bool(os.environ.get('MQT_FILESTORE_CLONE'))
     database = os.environ.get('MQT_TEST_DB', 'openerp_test')
+    log_prefix = os.environ.get('MQT_LOG_PREFIX', 'stdout')
     if not odoo_version:
         # For backward compatibility, take version from parameter
         # if it's not globally set
@@ -349,6 +864,11 @@ def main(argv=None):
     tested_addons_list = get_addons_to_check(travis_build_dir,
                                              odoo_include,
                                              odoo_exclude)
+    if (str2bool(os.environ.get('MQT_TEST_CHANGED')) and
+            os.environ.get('TRAVIS_PULL_REQUEST', 'false') != 'false'):
+        print("Testing only the modules changed and their dependents.")
+        tested_addons_list = get_addons_changed(
+            travis_build_dir, tested_addons_list, get_branch_base())
     tested_addons = ','.join(tested_addons_list)
 
     print("Working in %s" % travis_build_dir)
@@ -366,57 +886,134 @@ def main(argv=None):
     preinstall_modules = list(set(preinstall_modules) - set(get_modules(
         os.environ.get('TRAVIS_BUILD_DIR')))) or ['base']
     print("Modules to preinstall: %s" % preinstall_modules)
-    setup_server(dbtemplate, odoo_unittest, tested_addons_list, server_path,
-                 script_name, addons_path, install_options, preinstall_modules,
-                 unbuffer, server_options)
+    template_cache = os.environ.get('MQT_TEMPLATE_CACHE')
+    template_restored = False
+    if template_cache:
+        # The template is named by a hash of its content, so an outdated
+        # template is never used
+        template_cache = os.path.expanduser(template_cache)
+        template_hash = get_template_hash(
+            server_path, addons_path, preinstall_modules,
+            install_options + server_options)
+        if template_hash is None:
+            # The same hash for other versions of the server
+            print("The commit of the server in %s is unknown, "
+                  "MQT_TEMPLATE_CACHE not used." % server_path)
+            template_cache = None
+        else:
+            dbtemplate = '%s_%s' % (dbtemplate, template_hash[:12])
+    if not template_cache and os.environ.get('MQT_MATRIX_INDEX'):
+        # The combinations of MQT_MATRIX only share the template if they
+        # preinstall the same modules with the same options
+        dbtemplate = '%s_%s' % (dbtemplate, get_preinstall_hash(
+            preinstall_modules, install_options + server_options)[:12])
+    with template_lock(dbtemplate):
+        if template_cache:
+            template_restored = restore_template(
+                dbtemplate, template_cache, template_hash, data_dir)
+        if not template_restored:
+            setup_res = setup_server(
+                dbtemplate, odoo_unittest, tested_addons_list, server_path,
+                script_name, addons_path, install_options,
+                preinstall_modules, unbuffer, server_options)
+            if template_cache and setup_res == 0:
+                store_template(
+                    dbtemplate, template_cache, template_hash, data_dir)
 
     # Running tests
-    cmd_odoo_test = ["coverage", "run",
-                     "%s/%s" % (server_path, script_name),
-                     "-d", database,
-                     "--db-filter=^%s$" % database,
-                     "--stop-after-init",
-                     "--log-level", test_loglevel,
-                     ]
+    jobs = max(int(os.environ.get('MQT_JOBS') or 1), 1)
+    if instance_alive or not odoo_unittest:
+        # Only the modules tested one by one can run at the same time
+        jobs = 1
 
-    if test_loghandler is not None:
-        cmd_odoo_test += ['--log-handler', test_loghandler]
-    cmd_odoo_test += options + ["--init", None]
+    fork_server = None
+    if (str2bool(os.environ.get('MQT_WARM_SERVER')) and odoo_unittest and
+            not instance_alive):
+        if fork_server_supported():
+            # Odoo is imported once, and forked for each command
+            fork_server = ForkServer(server_path)
+            if not fork_server.wait_ready():
+                print("The fork server couldn't start, not used.")
+                fork_server.close()
+                fork_server = None
+        else:
+            print("MQT_WARM_SERVER needs python 3, not used.")
 
-    if odoo_unittest:
-        to_test_list = tested_addons_list
-        cmd_odoo_install = [
-            "%s/%s" % (server_path, script_name),
-            "-d", database,
-            "--stop-after-init",
-            "--log-level=warn",
-        ] + server_options + install_options + ["--init", None]
-        commands = ((cmd_odoo_install, False),
-                    (cmd_odoo_test, True),
+    single_run = (str2bool(os.environ.get('MQT_SINGLE_RUN')) and
+                  odoo_unittest and not instance_alive and test_enable)
+    if single_run and (get_version_major(odoo_version) or 0) < 12:
+        print("MQT_SINGLE_RUN needs the --test-tags of Odoo 12.0, not used.")
+        single_run = False
+
+    def get_commands(database, to_test):
+        server_cmd = ["%s/%s" % (server_path, script_name)]
+        if fork_server is not None:
+            cmd_odoo_test = fork_server.command(
+                coverage=True, parallel=True) + server_cmd
+        else:
+            # Each run writes its own coverage data file, combined by
+            # travis_after_tests_success
+            cmd_odoo_test = ["coverage", "run", "--parallel-mode"] + server_cmd
+        if single_run:
+            # The dependencies are installed by the same server, only the
+            # tests of the module are selected
+            cmd_odoo_test += get_test_args(
+                database, test_loglevel, test_loghandler, options,
+                server_options + install_options, to_test) + ["--init", None]
+            return ((cmd_odoo_test, True),
                     )
-    else:
-        to_test_list = [tested_addons]
-        commands = ((cmd_odoo_test, True),
+        cmd_odoo_test += get_test_args(
+            database, test_loglevel, test_loghandler, options) + [
+            "--init", None]
+
+        if odoo_unittest:
+            cmd_odoo_install = (
+                fork_server.command() if fork_server is not None else []
+            ) + server_cmd + [
+                "-d", database,
+                "--stop-after-init",
+                "--log-level=warn",
+            ] + server_options + install_options + ["--init", None]
+            return ((cmd_odoo_install, False),
+                    (cmd_odoo_test, True),
                     )
-    all_errors = []
-    counted_errors = 0
-    for to_test in to_test_list:
+        return ((cmd_odoo_test, True),
+                )
+
+    def test_module(to_test, log, echo=print, verbose=True):
+        """Run the commands to test to_test in a copy of the template
+        :param verbose: Print the output of the server while it is produced
+        :return: Tuple (number of errors found, boolean if to_test failed)
+        """
         if odoo_unittest:
-            print("\nTesting %s:" % [to_test])
+            echo("\nTesting %s:" % [to_test])
         else:
-            print("\nTesting %s:" % tested_addons_list)
-        try:
-            db_odoo_created = subprocess.call(
-                ["createdb", "-T", dbtemplate, database])
-            copy_attachments(dbtemplate, database, data_dir)
-        except subprocess.CalledProcessError:
-            db_odoo_created = True
+            echo("\nTesting %s:" % tested_addons_list)
+        if db_pool is not None:
+            try:
+                test_database = db_pool.get()
+            except (subprocess.CalledProcessError, OSError) as e:
+                echo(fail_msg, "Could not copy the template: %s" % e)
+                return 1, True
+            db_odoo_created = 0
+        else:
+            test_database = database
+            try:
+                db_odoo_created = subprocess.call(
+                    ["createdb", "-T", dbtemplate, test_database])
+                copy_attachments(
+                    dbtemplate, test_database, data_dir, clone_filestore)
+            except subprocess.CalledProcessError:
+                db_odoo_created = True
+        commands = get_commands(test_database, to_test)
+        counted_errors = 0
+        failed = False
         for command, check_loaded in commands:
             if db_odoo_created and instance_alive:
                 # If exists database of odoo test
                 # then start server with regular command without tests params
                 rm_items = [
-                    'coverage', 'run', '--stop-after-init',
+                    'coverage', 'run', '--parallel-mode', '--stop-after-init',
                     '--test-enable', '--init', None,
                     '--log-handler', 'openerp.tools.yaml_import:DEBUG',
                 ]
@@ -425,26 +1022,20 @@ def main(argv=None):
                                 if item not in rm_items] + \
                     ['--pidfile=/tmp/odoo.pid']
             else:
-                command[-1] = to_test
+                command = command[:-1] + [to_test]
                 # Run test command; unbuffer keeps output colors
                 command_call = (["unbuffer"] if unbuffer else []) + command
-            print(" ".join(cmd_strip_secret(command_call)))
-            pipe = subprocess.Popen(command_call,
-                                    stderr=subprocess.STDOUT,
-                                    stdout=subprocess.PIPE)
-            with open('stdout.log', 'wb') as stdout:
-                for line in iter(pipe.stdout.readline, b''):
-                    stdout.write(line)
-                    print(line.strip().decode(
-                        'UTF-8', errors='backslashreplace'
-                    ))
-            returncode = pipe.wait()
+            echo(" ".join(cmd_strip_secret(command_call)))
+            checker = LogErrorChecker(
+                test_database, odoo_version, check_loaded,
+                get_test_start(to_test) if single_run else None)
+            returncode = run_command(
+                command_call, log, checker, verbose)
             # Find errors, except from failed mails
-            errors = has_test_errors(
-                "stdout.log", database, odoo_version, check_loaded)
+            errors = checker.report(echo)
             if returncode != 0:
-                all_errors.append(to_test)
-                print(fail_msg, "Command exited with code %s" % returncode)
+                failed = True
+                echo(fail_msg, "Command exited with code %s" % returncode)
                 # If there are no errors,
                 # adds an error when returcode!=0
                 # because it's actually an error.
@@ -452,11 +1043,75 @@ def main(argv=None):
                     errors += 1
             if errors:
                 counted_errors += errors
-                all_errors.append(to_test)
-                print(fail_msg, "Found %d lines with errors" % errors)
-        if not instance_alive and odoo_unittest:
-            # Don't drop the database if will be used later.
-            subprocess.call(["dropdb", database])
+                failed = True
+                echo(fail_msg, "Found %d lines with errors" % errors)
+        if db_pool is not None:
+            db_pool.release(test_database)
+        return counted_errors, failed
+
+    if odoo_unittest:
+        to_test_list = tested_addons_list
+    else:
+        to_test_list = [tested_addons]
+    db_pool = None
+    if odoo_unittest and not instance_alive:
+        # Each module is tested in its own copy of the template, dropped
+        # after the test. Don't drop the database if will be used later.
+        db_pool = DatabasePool(
+            dbtemplate, database, data_dir,
+            size=int(os.environ.get('MQT_DB_POOL_SIZE') or 0),
+            limit=len(to_test_list), clone_filestore=clone_filestore)
+    if jobs > 1:
+        print("Testing %d modules at a time" % jobs)
+        # The output of each job is kept in its own log file, printed in
+        # the order of the modules: the one of the first module not done is
+        # printed while it is written, so the build is never silent for long
+        log_fnames = ['%s_%s.log' % (log_prefix, to_test)
+                      for to_test in to_test_list]
+        done = [threading.Event() for _ in to_test_list]
+        for log_fname in log_fnames:
+            open(log_fname, 'wb').close()
+
+        def test_module_job(index):
+            try:
+                # Unbuffered, to be read while it is written
+                with open(log_fnames[index], 'wb', 0) as log:
+                    def echo(*args):
+                        log.write((' '.join(args) + '\n').encode('UTF-8'))
+                    return test_module(
+                        to_test_list[index], log, echo, verbose=False)
+            finally:
+                done[index].set()
+
+        pool = ThreadPool(jobs)
+        try:
+            async_results = pool.map_async(
+                test_module_job, range(len(to_test_list)), chunksize=1)
+            for index, log_fname in enumerate(log_fnames):
+                stream_file(log_fname, done[index])
+            results = async_results.get()
+        finally:
+            pool.close()
+            pool.join()
+            if db_pool is not None:
+                db_pool.close()
+            if fork_server is not None:
+                fork_server.close()
+    else:
+        results = []
+        try:
+            for to_test in to_test_list:
+                with open(log_prefix + '.log', 'wb') as log:
+                    results.append(test_module(to_test, log))
+        finally:
+            if db_pool is not None:
+                db_pool.close()
+            if fork_server is not None:
+                fork_server.close()
+    all_errors = [to_test
+                  for to_test, (errors, failed) in zip(to_test_list, results)
+                  if failed]
+    counted_errors = sum(errors for errors, failed in results)
 
     print('Module test summary')
     for to_test in to_test_list:
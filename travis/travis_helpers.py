@@ -3,6 +3,8 @@
 helpers shared by the various QA tools
 """
 
+import sys
+
 
 RED = "\033[1;31m"
 GREEN = "\033[1;32m"
@@ -34,3 +36,20 @@ def yellow_light(text):
 
 fail_msg = red("FAIL")
 success_msg = green("Success")
+
+
+def stream_file(fname, done):
+    """Write the content of a file in the standard output while it is
+    written by another thread or process, until it is complete
+    :param fname: Path of the file
+    :param done: threading.Event set once the file is complete
+    """
+    sys.stdout.flush()
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    with open(fname, 'rb') as fobj:
+        while True:
+            finished = done.wait(1)
+            stdout.write(fobj.read())
+            stdout.flush()
+            if finished:
+                break